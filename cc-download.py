@@ -1,27 +1,58 @@
 #!/usr/bin/env python3
 import argparse
-import csv
-import gzip
 import hashlib
+import io
 import os
+import queue
 import shutil
 import sys
+import threading
 import time
 	
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from multiprocessing.pool import Pool
+from functools import partial
+from multiprocessing.pool import ThreadPool
 from typing import Optional, NamedTuple
-from urllib.request import urlopen, Request
-from http.client import HTTPResponse
-from typing import cast, Optional, Union, List
+from typing import Optional, Union, Iterable, Iterator, TypeVar, List, Tuple, Callable
 
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+from urllib3.exceptions import HTTPError
+from urllib3.util import Retry
 
-BUFSIZE=2**16
+try:
+	# ISA-L's gzip is a drop-in for the stdlib one, but a lot faster at inflating
+	from isal import igzip as gzip
+except ImportError:
+	import gzip
+
+
+# Response bodies are read in batches of this size (read() waits for the whole
+# batch), so each batch costs a single write() to the temp file.
+BUFSIZE=2**22
 
 CC_HOST='http://data.commoncrawl.org'
 
 MAX_ATTEMPTS = 10
 
+# Write down how far each range got after this many bytes, so even a killed
+# download doesn't have to start over.
+CHECKPOINT_INTERVAL = 2**28
+
+
+# Output is a tab-separated log with the columns timestamp, item, name, path,
+# size, time, md5 & error. Filled in directly rather than through the csv module.
+SUCCESS_ROW = '{timestamp}\t{item}\t{name}\t{path}\t{size}\t{time}\t{md5}\t\n'.format
+
+ERROR_ROW = '{timestamp}\t{item}\t{name}\t\t\t\t\t{error}\n'.format
+
+
+def format_error(err) -> str:
+	"""Error message on a single line, so it can't break up the log's rows."""
+	return ' '.join(str(err).split())
+
 
 class FileDownloaded(NamedTuple):
 	path: str
@@ -44,86 +75,301 @@ class DownloadError(NamedTuple):
 DownloadResult = Union[FileDownloaded, FileExists, DownloadError]
 
 
-def get_warc_list(crawl:str) -> List[str]:
-	with urlopen(f'{CC_HOST}/crawl-data/{crawl}/warc.paths.gz') as fz, gzip.open(fz, 'rt') as fh:
-		return list(line.rstrip() for line in fh)
+T = TypeVar('T')
+
 
+def get_warc_list(crawl:str) -> Iterator[str]:
+	# The compressed list is small, so fetch it in one go instead of keeping the
+	# connection open for the whole crawl. Only decompress it as it is consumed.
+	response = session.get(f'{CC_HOST}/crawl-data/{crawl}/warc.paths.gz', headers={'Accept-Encoding': 'identity'}, timeout=60)
+	response.raise_for_status()
+	data = response.content
+	with gzip.open(io.BytesIO(data), 'rt') as fh:
+		for line in fh:
+			yield line.rstrip()
 
-def get_content_length(response: HTTPResponse) -> int:
+
+def throttled(iterable:Iterable[T], slots:threading.Semaphore, stopped:threading.Event) -> Iterator[T]:
+	"""Only yield the next item once a slot is available. The consumer of the
+	pool's results releases a slot for each result, so the pool can't pull the
+	whole input into its task queue. Once `stopped` is set (the consumer quit),
+	stop waiting so the pool's task handler can shut down."""
+	for item in iterable:
+		while not slots.acquire(timeout=1):
+			if stopped.is_set():
+				return
+		yield item
+
+
+def get_content_length(response: requests.Response) -> int:
 	"""Get whole content length from either a normal or a Range request."""
-	content_range = response.getheader('Content-Range', '').split('/')
+	content_range = response.headers.get('Content-Range', '').split('/')
 	if len(content_range) == 2 and content_range[1] != '*':
 		return int(content_range[1])
 
-	size = response.getheader('Content-Length')
+	size = response.headers.get('Content-Length')
 	if size is not None:
 		return int(size)
 
 	raise ValueError('No content size')
 
 
-def download_warc(path:str) -> DownloadResult:
+class Renamer(threading.Thread):
+	"""Moves finished downloads into place in batches, with a single fsync() of
+	the destination directory per batch instead of a metadata commit per file.
+	The caller is expected to have synced the file's data itself. rename() only
+	returns once the rename has been synced to disk."""
+	def __init__(self, *, batch_size:int=16):
+		super().__init__(daemon=True)
+		self.batch_size = batch_size
+		self.queue: queue.Queue[Tuple[str, str, Future]] = queue.Queue()
+
+	def rename(self, src:str, dst:str) -> None:
+		future: Future = Future()
+		self.queue.put((src, dst, future))
+		future.result()
+
+	def run(self) -> None:
+		while True:
+			# Wait for the first rename, then take whatever else is queued up (e.g.
+			# during the previous sync) along into the same batch.
+			batch = [self.queue.get()]
+			while len(batch) < self.batch_size:
+				try:
+					batch.append(self.queue.get_nowait())
+				except queue.Empty:
+					break
+
+			renamed = []
+			for src, dst, future in batch:
+				try:
+					os.rename(src, dst)
+					renamed.append((dst, future))
+				except OSError as err:
+					future.set_exception(err)
+
+			# The renames are directory entries, so syncing each directory once makes
+			# the whole batch durable.
+			try:
+				for directory in {os.path.dirname(dst) or '.' for dst, _ in renamed}:
+					dir_fd = os.open(directory, os.O_RDONLY)
+					try:
+						os.fsync(dir_fd)
+					finally:
+						os.close(dir_fd)
+			except OSError as err:
+				for _, future in renamed:
+					future.set_exception(err)
+			else:
+				for _, future in renamed:
+					future.set_result(None)
+
+
+def split_ranges(size:int, count:int, *, done:int=0) -> List[List[int]]:
+	"""Split [0, size) into `count` byte ranges of [offset, end). The first
+	`done` bytes are considered downloaded already."""
+	bounds = [size * n // count for n in range(count + 1)]
+	return [
+		[max(start, min(done, end)), end]
+		for start, end in zip(bounds[:-1], bounds[1:])
+	]
+
+
+def read_ranges(ranges_name:str) -> Tuple[int, List[List[int]]]:
+	"""Raises ValueError if the file is not a complete ranges file."""
+	with open(ranges_name, 'r') as fh:
+		try:
+			size = int(next(fh))
+			ranges = [[int(n) for n in line.split()] for line in fh]
+		except (StopIteration, ValueError) as err:
+			raise ValueError(f'Unreadable ranges file {ranges_name}') from err
+	if any(len(byte_range) != 2 for byte_range in ranges):
+		raise ValueError(f'Unreadable ranges file {ranges_name}')
+	return size, ranges
+
+
+ranges_lock = threading.Lock()
+
+
+def write_ranges(ranges_name:str, size:int, ranges:List[List[int]]) -> None:
+	# Write to a new file, sync it and move it over the old one, so that a crash
+	# or interrupted write never leaves us without a usable progress file. Range
+	# threads of the same download checkpoint to the same file, hence the lock.
+	with ranges_lock:
+		with open(f'{ranges_name}~', 'w') as fh:
+			fh.write(f'{size}\n')
+			for offset, end in ranges:
+				fh.write(f'{offset} {end}\n')
+			fh.flush()
+			os.fsync(fh.fileno())
+		os.replace(f'{ranges_name}~', ranges_name)
+
+
+def save_progress(fd:int, ranges_name:str, size:int, ranges:List[List[int]]) -> None:
+	"""Write down `ranges`, but only as far as they have made it to disk."""
+	progress = [list(byte_range) for byte_range in ranges]
+	os.fdatasync(fd)
+	write_ranges(ranges_name, size, progress)
+
+
+def download_range(url:str, fd:int, byte_range:List[int], size:int, *, checkpoint:Callable[[],None]) -> None:
+	"""Download the bytes [offset, end) in `byte_range` from `url` and write them
+	to the same offsets in `fd`. The offset in `byte_range` is moved forward as
+	data is written, so after an error it still says where to resume. Every
+	CHECKPOINT_INTERVAL bytes, `checkpoint` is called to save that progress."""
+	unsaved = 0
+
+	attempt = 0
+	while byte_range[0] < byte_range[1]:
+		attempt += 1
+		if attempt > MAX_ATTEMPTS:
+			raise Exception(f'Downloaded not enough: {byte_range[0]} < {byte_range[1]}')
+
+		try:
+			with session.get(url, headers={'Range': f'bytes={byte_range[0]}-{byte_range[1] - 1}'}, stream=True, timeout=60) as response:
+				response.raise_for_status()
+
+				# Anything but the range we asked for would end up at the wrong offset
+				if response.status_code != 206:
+					raise Exception(f'Expected partial content, got status {response.status_code}')
+
+				if get_content_length(response) != size:
+					raise Exception(f'File size changed: {get_content_length(response)} != {size}')
+
+				# Read downloaded bytes, writing them to the temp file until there's
+				# nothing left to read.
+				while True:
+					# urllib3's readinto() is just read() plus a copy, so take the bytes
+					# from read() and write those directly.
+					data = response.raw.read(BUFSIZE)
+					length = len(data)
+					if length == 0:
+						break
+
+					# If we're somehow past our expected range, something went wrong
+					if byte_range[0] + length > byte_range[1]:
+						raise Exception(f'Downloaded too much: {byte_range[0] + length} > {byte_range[1]}')
+
+					chunk = memoryview(data)
+					while len(chunk) > 0:
+						written = os.pwrite(fd, chunk, byte_range[0])
+						chunk = chunk[written:]
+						byte_range[0] += written
+
+					unsaved += length
+					if unsaved >= CHECKPOINT_INTERVAL:
+						checkpoint()
+						unsaved = 0
+		except (ConnectionError, Timeout, HTTPError):
+			# Connection broke off halfway: resume from where we got on the next
+			# attempt, over a pooled connection.
+			if attempt == MAX_ATTEMPTS:
+				raise
+
+
+def download_warc(path:str, *, range_parts:int=1) -> DownloadResult:
 	file_name = os.path.basename(path)
 	temp_name = f'.{file_name}'
+	ranges_name = f'.{file_name}.ranges'
+	url = f'{CC_HOST}/{path}'
 	size: Optional[int] = None
 	start_time = datetime.now()
 
-	if os.path.exists(file_name):
+	try:
+		os.stat(file_name)
+		# Interrupted between the rename and removing the ranges file. Clean it
+		# up, or it would be taken for a download in progress later on.
+		try:
+			os.unlink(ranges_name)
+		except FileNotFoundError:
+			pass
 		return FileExists(path)
+	except FileNotFoundError:
+		pass
 
 	try:
-		# Open the temp file (it may already exist from a previously interrupted session)
-		with open(temp_name, 'a+b') as ftemp:
-			# Restart the md5 hash and read ftemp to end, after which we'll append
-			ftemp.seek(0)
-			digest = hashlib.md5()
-			while True:
-				chunk = ftemp.read(BUFSIZE)
-				if len(chunk) == 0:
-					break
-				digest.update(chunk)
-
-			# Attempt downloading, resuming based on how much is already on disk
-			attempt = 0
-			while attempt < MAX_ATTEMPTS:
-				attempt += 1
-				
-				request = Request(f'{CC_HOST}/{path}', headers={
-					'Range': f'bytes={ftemp.tell()}-'
-				})
-
-				with urlopen(request) as fin:
-					# Get the expected full content length (throws if not available)
-					size = get_content_length(cast(HTTPResponse, fin))
-
-					# Read downloaded bytes, writing them to the digest & temp file
-					# until there's nothing left to read.
-					while True:
-						chunk = fin.read(BUFSIZE)
-						if len(chunk) == 0:
-							break
-						ftemp.write(chunk)
-						digest.update(chunk)
-
-				# If we haven't finished the whole promised file yet, re-attempt
-				if ftemp.tell() < size:
-					continue
-
-				# If we're somehow past our expected size, something went wrong
-				elif ftemp.tell() > size:
-					raise Exception(f'Downloaded too much: {ftemp.tell()} > {size}')
-
-				# Otherwise, make temp file permanent
-				os.rename(temp_name, file_name)
-				return FileDownloaded(
-					path=path,
-					size=size,
-					md5=digest.hexdigest(),
-					time=(datetime.now() - start_time).seconds)
-			
-			# If we ran through all attempts of the loop without ever returning
-			# FileDownloaded or throwing an exception: sad.
-			raise Exception(f'Downloaded not enough: {ftemp.tell()} < {size}')
+		# Byte ranges that are (still) to be downloaded. These are kept next to the
+		# temp file so a download interrupted in a previous session can resume
+		# without asking for the size again. If they're all done, there's no need
+		# for any request at all. (The range requests check the size is unchanged.)
+		# The ranges are only any good together with the temp file they describe:
+		# if that's gone, start over.
+		try:
+			size, ranges = read_ranges(ranges_name)
+			fd = os.open(temp_name, os.O_RDWR)
+		except (FileNotFoundError, ValueError) as err:
+			# Without readable ranges there's no telling which parts of the temp file
+			# are downloaded, so throw both away and start over.
+			if isinstance(err, ValueError):
+				for name in (ranges_name, temp_name):
+					try:
+						os.unlink(name)
+					except FileNotFoundError:
+						pass
+
+			# Get the expected full content length (throws if not available)
+			response = session.head(url, allow_redirects=True, timeout=60)
+			response.raise_for_status()
+			size = get_content_length(response)
+
+			# A temp file without ranges is from before downloads were split up,
+			# and is filled from the start.
+			try:
+				done = os.stat(temp_name).st_size
+			except FileNotFoundError:
+				done = 0
+			ranges = split_ranges(size, range_parts, done=done)
+			write_ranges(ranges_name, size, ranges)
+
+			fd = os.open(temp_name, os.O_RDWR | os.O_CREAT, 0o666)
+
+		try:
+			# Reserve the whole file on disk in one go, rather than the filesystem
+			# growing (and fragmenting) it as the ranges come in.
+			if size > 0:
+				os.posix_fallocate(fd, 0, size)
+
+			pending = [byte_range for byte_range in ranges if byte_range[0] < byte_range[1]]
+			if len(pending) > 0:
+				try:
+					with ThreadPoolExecutor(len(pending)) as executor:
+						futures = [
+							executor.submit(download_range, url, fd, byte_range, size,
+								checkpoint=partial(save_progress, fd, ranges_name, size, ranges))
+							for byte_range in pending
+						]
+					for future in futures:
+						future.result()
+				finally:
+					save_progress(fd, ranges_name, size, ranges)
+
+			# The temp file is preallocated, so its size says nothing. The ranges do.
+			if any(offset < end for offset, end in ranges):
+				raise Exception(f'Downloaded not enough: {sum(end - offset for offset, end in ranges)} bytes missing')
+
+			# Ranges arrive in any order, so hash the finished file in one go
+			os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+			with open(fd, 'rb', buffering=0, closefd=False) as ftemp:
+				digest = hashlib.file_digest(ftemp, 'md5')
+
+			# Make temp file permanent. The ranges file goes only after that: a
+			# preallocated temp file without it would be taken for one from before
+			# downloads were split up, and its missing bits as downloaded.
+			os.fdatasync(fd)
+			renamer.rename(temp_name, file_name)
+			os.unlink(ranges_name)
+
+			# It's on disk now & we won't read it again, so don't let it push other
+			# files out of the page cache.
+			os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+		finally:
+			os.close(fd)
+
+		return FileDownloaded(
+			path=path,
+			size=size,
+			md5=digest.hexdigest(),
+			time=(datetime.now() - start_time).seconds)
 	except Exception as err:
 		return DownloadError(
 					path=path,
@@ -135,27 +381,53 @@ def download_warc(path:str) -> DownloadResult:
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
 	parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), help='parallel downloads')
+	parser.add_argument('--range-parts', type=int, default=4, help='parallel range requests per download')
 	parser.add_argument('crawl', type=str)
 	args = parser.parse_args()
 
-	out = csv.DictWriter(sys.stdout, ['timestamp', 'item', 'name', 'path', 'size', 'time', 'md5', 'error'], delimiter='\t')
-
-	with Pool(args.jobs) as pool:
-		for result in pool.imap_unordered(download_warc, get_warc_list(args.crawl)):
-			if isinstance(result, FileDownloaded):
-				out.writerow({
-					'timestamp': datetime.now().isoformat(),
-					'item': os.path.basename(result.path),
-					'name': os.path.basename(result.path),
-					'path': result.path,
-					'size': result.size,
-					'time': result.time,
-					'md5':  result.md5,
-				})
-			elif isinstance(result, DownloadError):
-				out.writerow({	
-					'timestamp': datetime.now().isoformat(),
-					'item': os.path.basename(result.path),
-					'name': os.path.basename(result.path),
-					'error': result.error,
-				})
+	if args.range_parts < 1:
+		parser.error('--range-parts must be at least 1')
+
+	# One session for all download threads, with a keep-alive connection for
+	# each concurrent range request. Failed connections & gateway errors are
+	# retried by urllib3.
+	session = requests.Session()
+	session.mount(CC_HOST, HTTPAdapter(
+		pool_maxsize=args.jobs * args.range_parts,
+		max_retries=Retry(total=MAX_ATTEMPTS, backoff_factor=0.5, status_forcelist=[502, 503, 504])))
+
+	renamer = Renamer()
+	renamer.start()
+
+	out = sys.stdout.buffer
+
+	slots = threading.Semaphore(args.jobs * 2)
+	stopped = threading.Event()
+
+	# Downloads spend nearly all their time waiting on the network, so threads
+	# give us the same parallelism as processes without the fork & pickle cost.
+	with ThreadPool(args.jobs) as pool:
+		try:
+			for result in pool.imap_unordered(partial(download_warc, range_parts=args.range_parts), throttled(get_warc_list(args.crawl), slots, stopped), chunksize=1):
+				slots.release()
+				if isinstance(result, FileDownloaded):
+					out.write(SUCCESS_ROW(
+						timestamp=datetime.now().isoformat(),
+						item=os.path.basename(result.path),
+						name=os.path.basename(result.path),
+						path=result.path,
+						size=result.size,
+						time=result.time,
+						md5=result.md5,
+					).encode())
+				elif isinstance(result, DownloadError):
+					out.write(ERROR_ROW(
+						timestamp=datetime.now().isoformat(),
+						item=os.path.basename(result.path),
+						name=os.path.basename(result.path),
+						error=format_error(result.error),
+					).encode())
+		finally:
+			# No more results will be taken, and so no more slots released. Let the
+			# feeder know before the pool waits for it.
+			stopped.set()
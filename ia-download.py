@@ -3,17 +3,21 @@ import argparse
 import sys
 import os
 import hashlib
-import csv
 import internetarchive as ia
 import random
+import shutil
 import dbm
-import pickle
+import msgpack
 import time
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 from contextlib import ExitStack
 from datetime import datetime
-from typing import NamedTuple, List, Tuple, Union, Optional, Callable, TypeVar, Iterable
-from multiprocessing import Pool
-from itertools import repeat
+from functools import partial
+from typing import NamedTuple, List, Tuple, Union, Optional, Callable, TypeVar, Iterable, Iterator
+from multiprocessing.pool import ThreadPool
+from itertools import islice, repeat
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError
 
 
@@ -25,6 +29,7 @@ class File(NamedTuple):
 	name: str
 	url: str
 	md5: str
+	size: Optional[int] = None
 
 
 class Download(NamedTuple):
@@ -34,21 +39,72 @@ class Download(NamedTuple):
 	time: int
 
 
+# Output is a tab-separated log with the columns timestamp, item, name, path,
+# size, time, md5 & error. Filled in directly rather than through the csv module.
+SUCCESS_ROW = '{timestamp}\t{item}\t{name}\t{path}\t{size}\t{time}\t{md5}\t\n'.format
+
+ERROR_ROW = '{timestamp}\t{item}\t{name}\t\t\t\t\t{error}\n'.format
+
+
+def format_error(err) -> str:
+	"""Error message on a single line, so it can't break up the log's rows."""
+	return ' '.join(str(err).split())
+
+
 In = TypeVar('In')
 Out = TypeVar('Out')
 
 class FakePool:
-	"""multiprocessing.Pool but running in this thread. Useful for getting
+	"""multiprocessing.pool.ThreadPool but running in this thread. Useful for getting
 	stack traces from exception occurring in the callback."""
-	def imap_unordered(self, fn:Callable[[In],Out], iterable:Iterable[In]) -> Iterable[Out]:
+	def imap_unordered(self, fn:Callable[[In],Out], iterable:Iterable[In], chunksize:int=1) -> Iterable[Out]:
 		for item in iterable:
 			yield fn(item)
 
 
+class TeeWriter:
+	"""File-like object that writes to `file` and feeds the same data to
+	`digest`, so shutil.copyfileobj() can do both in one go."""
+	def __init__(self, file, digest):
+		self.file = file
+		self.digest = digest
+
+	def write(self, data) -> int:
+		self.digest.update(data)
+		return self.file.write(data)
+
+
+def throttled(iterable:Iterable[In], slots:threading.Semaphore, stopped:threading.Event) -> Iterator[In]:
+	"""Only yield the next item once a slot is available. The consumer of the
+	pool's results releases a slot for each result, so the pool can't pull the
+	whole input into its task queue. Once `stopped` is set (the consumer quit),
+	stop waiting so the pool's task handler can shut down."""
+	for item in iterable:
+		while not slots.acquire(timeout=1):
+			if stopped.is_set():
+				return
+		yield item
+
+
+def prefetched(executor:Executor, fn:Callable[[In],Out], iterable:Iterable[In], *, lookahead:int) -> Iterator[Tuple[In,Out]]:
+	"""Yields (item, fn(item)) for each item in iterable, in the order they
+	finish. Runs fn in executor for up to `lookahead` items ahead, so one slow
+	call doesn't hold up the others."""
+	iterator = iter(iterable)
+	pending = {executor.submit(fn, item): item for item in islice(iterator, lookahead)}
+	while len(pending) > 0:
+		done, _ = wait(pending, return_when=FIRST_COMPLETED)
+		for future in done:
+			item = pending.pop(future)
+			for next_item in islice(iterator, 1):
+				pending[executor.submit(fn, next_item)] = next_item
+			yield item, future.result()
+
+
 def download_file(session, file:File, file_path:str, *, timeout=60) -> Tuple[Download,int]:
 	# Construct temporary filename in same directory
 	dest_dir, file_name = os.path.split(file_path)
-	temp_path = os.path.join(dest_dir, f'.{file_name}~{os.getpid()}')
+	temp_path = os.path.join(dest_dir, f'.{file_name}~{os.getpid()}-{threading.get_ident()}')
 
 	start_time = datetime.now()
 
@@ -60,12 +116,27 @@ def download_file(session, file:File, file_path:str, *, timeout=60) -> Tuple[Dow
 
 	# Fetch body, calculate checksum as we read through its chunks
 	digest = hashlib.md5()
-	size = 0
 	try:
 		with open(temp_path, 'wb') as fout:
-			for chunk in response.iter_content(chunk_size=1048576):
-				size += fout.write(chunk)
-				digest.update(chunk)
+			# Reserve the whole file on disk in one go, rather than the filesystem
+			# growing (and fragmenting) it chunk by chunk.
+			content_length = int(response.headers.get('Content-Length', 0))
+			if content_length > 0:
+				os.posix_fallocate(fout.fileno(), 0, content_length)
+
+			# Store the body exactly as sent (IA serves files as-is), which is also
+			# what file.md5 is of. Skips urllib3's decoder for every chunk.
+			response.raw.decode_content = False
+			shutil.copyfileobj(response.raw, TeeWriter(fout, digest), 1048576)
+			size = fout.tell()
+
+			# Drop any preallocated space we didn't end up writing to
+			fout.truncate()
+
+			# We won't read it again, so don't let it push other files out of the
+			# page cache. The kernel can only drop pages once they're written out.
+			os.fdatasync(fout.fileno())
+			os.posix_fadvise(fout.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
 
 		if digest.hexdigest() != file.md5:
 			print(f"ERROR: md5 mismatch when downloading {file.url}", file=sys.stderr)
@@ -76,27 +147,18 @@ def download_file(session, file:File, file_path:str, *, timeout=60) -> Tuple[Dow
 	finally:
 		# Clean up tempfile in case of error
 		# TODO: Resume download if we implement Partial or chunked download.
-		if os.path.exists(temp_path):
+		try:
 			os.unlink(temp_path)
+		except FileNotFoundError:
+			pass
 
 	return Download(file_path, size, digest.hexdigest(), (datetime.now() - start_time).seconds)
 
 
-def compute_md5(path:str, *, buffering=2**16) -> str:
-	with open(path, 'rb', buffering=buffering) as fh:
-		digest = hashlib.md5()
-		while True:
-			chunk = fh.read(buffering)
-			if len(chunk) == 0:
-				break
-			digest.update(chunk)
-		return digest.hexdigest()
-
-
-def worker_setup():
-	global session
-	session = ia.api.get_session()
-	session.mount_http_adapter(max_retries=2)
+def compute_md5(path:str) -> str:
+	# Unbuffered, so file_digest() reads straight from the file descriptor
+	with open(path, 'rb', buffering=0) as fh:
+		return hashlib.file_digest(fh, 'md5').hexdigest()
 
 
 def worker_download_file(entry: Tuple[Tuple[str, File],str,bool]) -> Tuple[str,File,Union[Tuple[Download,int],Exception]]:
@@ -106,14 +168,26 @@ def worker_download_file(entry: Tuple[Tuple[str, File],str,bool]) -> Tuple[str,F
 	file_path = os.path.join(item_path, file.name)
 	retval = None
 	
-	# If we find the wrong md5, delete the file.
-	if check_md5 and os.path.exists(file_path):
-		file_md5 = compute_md5(file_path)
-		if file_md5 != file.md5:
-			print(f"md5 mismatch: {file_path}\t{file_md5}\t{file.md5}", file=sys.stderr)
+	try:
+		stat = os.stat(file_path)
+	except FileNotFoundError:
+		stat = None
+
+	# If we find the wrong md5, delete the file. A wrong size we can spot without
+	# reading the file.
+	if check_md5 and stat is not None:
+		if file.size is not None and stat.st_size != file.size:
+			print(f"size mismatch: {file_path}\t{stat.st_size}\t{file.size}", file=sys.stderr)
 			os.unlink(file_path)
+			stat = None
+		else:
+			file_md5 = compute_md5(file_path)
+			if file_md5 != file.md5:
+				print(f"md5 mismatch: {file_path}\t{file_md5}\t{file.md5}", file=sys.stderr)
+				os.unlink(file_path)
+				stat = None
 
-	if not os.path.exists(file_path):
+	if stat is None:
 		try:
 			os.makedirs(item_path, exist_ok=True)
 			retval = download_file(session, file, file_path)
@@ -123,10 +197,20 @@ def worker_download_file(entry: Tuple[Tuple[str, File],str,bool]) -> Tuple[str,F
 	return item, file, retval
 
 
+# Listings are fetched from multiple threads, but dbm isn't thread-safe
+cache_lock = threading.Lock()
+
+
 def ia_get_files(cache, session, item:str, *, glob_pattern:Optional[str]=None) -> List[File]:
 	key = f"{item}${glob_pattern!s}"
-	if cache is not None and key in cache:
-		return pickle.loads(cache[key])
+	if cache is not None:
+		with cache_lock:
+			cached = cache.get(key)
+		if cached is not None:
+			try:
+				return [File(*entry) for entry in msgpack.unpackb(cached, raw=False)]
+			except (ValueError, TypeError):
+				pass # Not msgpack, e.g. pickled by an older version. Fetch it again.
 	
 	response = None
 	for retry in range(1, 6):
@@ -140,10 +224,11 @@ def ia_get_files(cache, session, item:str, *, glob_pattern:Optional[str]=None) -
 			else:
 				raise
 	
-	files = [File(file.name, file.url, file.md5) for file in response]
+	files = [File(file.name, file.url, file.md5, int(file.size) if file.size else None) for file in response]
 	
 	if cache is not None:
-		cache[key] = pickle.dumps(files)
+		with cache_lock:
+			cache[key] = msgpack.packb(files, use_bin_type=True)
 
 	return files
 
@@ -160,7 +245,12 @@ if __name__ == '__main__':
 
 	args = parser.parse_args()
 
-	session = ia.api.get_session()
+	# One session shared by all download threads (and the item listing). Size its
+	# connection pools for that many threads.
+	session = ia.api.get_session(http_adapter_kwargs={'pool_maxsize': args.jobs})
+	session.mount('http://', HTTPAdapter(pool_maxsize=args.jobs))
+	session.mount('https://', HTTPAdapter(pool_maxsize=args.jobs))
+	session.mount_http_adapter(max_retries=2)
 
 	if not args.identifiers:
 		args.identifiers = (line.rstrip('\n') for line in sys.stdin)
@@ -172,10 +262,15 @@ if __name__ == '__main__':
 	with ExitStack() as ctx:
 		cache = ctx.enter_context(dbm.open(args.cache, 'c', mode=0o600)) if args.cache else None
 
+		# Fetch file listings in the background, a few items ahead of the downloads,
+		# so an item that needs retrying (and backing off) doesn't stall them.
+		listings = ThreadPoolExecutor(max_workers=8)
+		ctx.callback(listings.shutdown, cancel_futures=True)
+
 		files = (
 			(item, file)
-			for item in args.identifiers
-			for file in ia_get_files(cache, session, item, glob_pattern=args.filter)
+			for item, item_files in prefetched(listings, partial(ia_get_files, cache, session, glob_pattern=args.filter), args.identifiers, lookahead=32)
+			for file in item_files
 		)
 
 		total_errors = 0
@@ -185,34 +280,42 @@ if __name__ == '__main__':
 		consecutive_errors = 0
 
 		if args.jobs > 1:
-			pool = ctx.enter_context(Pool(args.jobs, initializer=worker_setup))
+			pool = ctx.enter_context(ThreadPool(args.jobs))
 		else:
 			pool = FakePool()
 
-		out = csv.DictWriter(sys.stdout, ['timestamp', 'item', 'name', 'path', 'size', 'time', 'md5', 'error'], delimiter='\t')
+		out = sys.stdout.buffer
+
+		slots = threading.Semaphore(args.jobs * 2)
+
+		# No more results will be taken once we leave this block, and so no more
+		# slots released. Let the feeder know before the pool waits for it.
+		stopped = threading.Event()
+		ctx.callback(stopped.set)
+
+		for item, file, retval in pool.imap_unordered(worker_download_file, throttled(zip(files, repeat(args.dest), repeat(args.check_md5)), slots, stopped), chunksize=1):
+			slots.release()
 
-		for item, file, retval in pool.imap_unordered(worker_download_file, zip(files, repeat(args.dest), repeat(args.check_md5))):
 			if retval is None:
 				continue
 			elif isinstance(retval, Download):
-				out.writerow({
-					'timestamp': datetime.now().isoformat(),
-					'item': item,
-					'name': file.name,
-					'path': retval.path,
-					'size': retval.size,
-					'time': retval.time,
-					'md5': retval.md5,
-					
-				})
+				out.write(SUCCESS_ROW(
+					timestamp=datetime.now().isoformat(),
+					item=item,
+					name=file.name,
+					path=retval.path,
+					size=retval.size,
+					time=retval.time,
+					md5=retval.md5,
+				).encode())
 				consecutive_errors = 0
 			else:
-				out.writerow({
-					'timestamp': datetime.now().isoformat(),
-					'item': item,
-					'name': file.name,
-					'error': str(retval)
-				})
+				out.write(ERROR_ROW(
+					timestamp=datetime.now().isoformat(),
+					item=item,
+					name=file.name,
+					error=format_error(retval),
+				).encode())
 				consecutive_errors += 1
 				total_errors += 1
 